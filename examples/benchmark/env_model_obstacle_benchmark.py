@@ -0,0 +1,69 @@
+#  Copyright (c). All Rights Reserved.
+#  General Optimal control Problem Solver (GOPS)
+#  Intelligent Driving Lab(iDLab), Tsinghua University
+#
+#  Creator: Baiyu Peng
+#  Description: Cost of one step of the mobile robot environment model vs. the number of obstacles
+
+
+import os
+import sys
+import time
+import warnings
+
+import torch
+
+gops_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..')
+sys.path.insert(0, gops_path)
+
+import modules.create_pkg
+from pyth_mobilerobot2_model import PythMobilerobot2Model
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+
+def looped_forward(model, state, action):
+    # per-obstacle loop with a growing torch.cat, as the model was written for a single obstacle
+    veh2vehdist = torch.zeros(state.shape[0], model.n_obstacle)
+    robot_state = model.robot.f_xu(state[:, :5], action, model.dt, 'ego')
+    state_next = torch.cat((robot_state, model.robot.tracking_error(robot_state)), 1)
+    for i in range(1, 1 + model.n_obstacle):
+        obs_state = model.robot.f_xu(state[:, 3+i*5:3+i*5+5], state[:, 3+i*5+3:3+i*5+5], model.dt, 'obs')
+        state_next = torch.cat((state_next, obs_state), 1)
+        veh2vehdist[:, i-1] = model.safe_dis[i-1] - torch.sqrt(
+            torch.square(state_next[:, 3+i*5] - state_next[:, 0]) + torch.square(state_next[:, 3+i*5+1] - state_next[:, 1]))
+    return state_next, veh2vehdist
+
+
+def vectorized_forward(model, state, action):
+    state_next, _, _, info = model.forward(state, action, None)
+    return state_next, info['constraint']
+
+
+def time_step(func, model, state, action, repeat=20, warmup=3):
+    def run():
+        state.grad = None
+        state_next, constraint = func(model, state, action)
+        (state_next.sum() + constraint.sum()).backward()
+
+    for _ in range(warmup):
+        run()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) / repeat * 1000  # ms
+
+
+if __name__ == "__main__":
+    warnings.simplefilter('ignore')
+    batch_size = 4096
+    print('{:>10} | {:>10} {:>14}'.format('obstacles', 'loop[ms]', 'vectorized[ms]'))
+    for n_obstacle in [1, 5, 10, 25, 50]:
+        model = PythMobilerobot2Model(n_obstacle=n_obstacle)
+        state = torch.zeros(batch_size, model.state_dim)
+        state[:, 8::5] = torch.rand(batch_size, n_obstacle) * 6
+        state[:, 9::5] = torch.rand(batch_size, n_obstacle) * 2 - 1
+        state.requires_grad_()
+        action = torch.zeros(batch_size, model.action_dim)
+        print('{:>10} | {:>10.2f} {:>14.2f}'.format(
+            n_obstacle, time_step(looped_forward, model, state, action), time_step(vectorized_forward, model, state, action)))
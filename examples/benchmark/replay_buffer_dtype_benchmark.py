@@ -0,0 +1,57 @@
+#  Copyright (c). All Rights Reserved.
+#  General Optimal control Problem Solver (GOPS)
+#  Intelligent Driving Lab(iDLab), Tsinghua University
+#
+#  Creator: Yang GUAN
+#  Description: Memory and throughput of the replay buffer vs. the storage dtype of the observations
+
+
+import os
+import sys
+import time
+
+import numpy as np
+
+gops_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..')
+sys.path.insert(0, gops_path)
+
+from modules.trainer.buffer.replay_buffer import ReplayBuffer
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+
+def make_columns(n, obsv_dim, n_obstacle):
+    # positions within ±30, headings within ±2π, the ranges of the mobile robot states
+    obs = np.random.uniform(-30, 30, (n + 1, obsv_dim)).astype(np.float32)
+    headings = [2] + [10 + 5 * k for k in range(n_obstacle)]
+    obs[:, headings] = np.random.uniform(-2 * np.pi, 2 * np.pi, (n + 1, len(headings)))
+    return {'obs': obs[:-1], 'obs2': obs[1:], 'act': np.random.randn(n, 2).astype(np.float32),
+            'rew': np.random.randn(n).astype(np.float32), 'done': np.zeros(n, dtype=np.float32),
+            'logp': np.zeros(n, dtype=np.float32), 'con': np.random.randn(n, n_obstacle).astype(np.float32)}
+
+
+def benchmark(dtype, obsv_dim, n_obstacle, max_size=400 * 1000, insert_size=1000, batch_size=4096, repeat=50):
+    buffer = ReplayBuffer(obsv_dim=obsv_dim, action_dim=2, constraint_dim=n_obstacle, buffer_max_size=max_size,
+                          buffer_dtypes={'obs': dtype, 'obs2': dtype}, sample_out_ring=2)
+    columns = make_columns(insert_size, obsv_dim, n_obstacle)
+    start = time.perf_counter()
+    for _ in range(max_size // insert_size):
+        buffer.add_batch(columns)
+    insert_rate = max_size / (time.perf_counter() - start)
+    buffer.sample_batch(batch_size)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        buffer.sample_batch(batch_size)
+    sample_rate = repeat * batch_size / (time.perf_counter() - start)
+    error = np.abs(buffer.gather('obs', np.arange(insert_size)) - columns['obs']).max()
+    nbytes = sum(v.nbytes for v in buffer.buf.values())
+    return nbytes / 1e6, insert_rate / 1e6, sample_rate / 1e6, error
+
+
+if __name__ == "__main__":
+    print('{:>10} {:>9} | {:>8} {:>12} {:>12} {:>10}'.format(
+        'obstacles', 'dtype', 'MB', 'insert[M/s]', 'sample[M/s]', 'max error'))
+    for n_obstacle in [1, 10]:
+        for dtype in ['float32', 'float16', 'bfloat16']:
+            print('{:>10} {:>9} | {:>8.1f} {:>12.2f} {:>12.2f} {:>10.4f}'.format(
+                n_obstacle, dtype, *benchmark(dtype, 8 + 5 * n_obstacle, n_obstacle)))
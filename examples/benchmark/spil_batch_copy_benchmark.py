@@ -0,0 +1,72 @@
+#  Copyright (c). All Rights Reserved.
+#  General Optimal control Problem Solver (GOPS)
+#  Intelligent Driving Lab(iDLab), Tsinghua University
+#
+#  Creator: Baiyu Peng
+#  Description: Allocation of the replay batch handling in SPIL.compute_gradient,
+#               deep copy of the batch before each loss vs. the read-only batch view
+
+
+import os
+import sys
+import time
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+gops_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..')
+sys.path.insert(0, gops_path)
+
+import modules.create_pkg
+from modules.algorithm.spil import SPIL
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+ARGS = dict(env_id='pyth_mobilerobot2', algorithm='SPIL', trainer='off_serial_trainer', use_gpu=False,
+            obsv_dim=13, action_dim=2, constraint_dim=1, action_type='continu',
+            action_high_limit=np.array([0.4, np.pi / 3], dtype=np.float32),
+            action_low_limit=np.array([-0.4, -np.pi / 3], dtype=np.float32),
+            value_func_name='StateValue', value_func_type='MLP', value_hidden_sizes=[64, 64],
+            value_hidden_activation='relu', value_output_activation='linear',
+            policy_func_name='DetermPolicy', policy_func_type='MLP', policy_hidden_sizes=[64, 64],
+            policy_hidden_activation='elu', policy_output_activation='tanh',
+            value_learning_rate=2e-3, policy_learning_rate=0.3e-3)
+
+
+def replay_batch(batch_size, obsv_dim=13, act_dim=2, con_dim=1):
+    # same fields and dtypes as ReplayBuffer.sample_batch
+    return {'obs': torch.rand(batch_size, obsv_dim), 'obs2': torch.rand(batch_size, obsv_dim),
+            'act': torch.rand(batch_size, act_dim), 'rew': torch.rand(batch_size),
+            'done': torch.zeros(batch_size), 'logp': torch.zeros(batch_size),
+            'con': torch.rand(batch_size, con_dim)}
+
+
+def allocated_bytes(data, func):
+    # bytes of tensor storage that func allocates on top of the replay batch it is given
+    shared = {v.data_ptr() for v in data.values()}
+    batches = func()
+    batches = batches if isinstance(batches, tuple) else (batches,)
+    return sum(v.numel() * v.element_size() for batch in batches for v in batch.values()
+               if v.data_ptr() not in shared)
+
+
+def timed(func, repeat=200):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6  # us
+
+
+if __name__ == "__main__":
+    alg = SPIL(**ARGS)
+    print('{:>10} | {:>14} {:>10} | {:>14} {:>10}'.format(
+        'batch', 'deepcopy [KB]', '[us]', 'view [KB]', '[us]'))
+    for batch_size in [1024, 4096, 16384, 65536]:
+        data = replay_batch(batch_size)
+        # previous behaviour: one deep copy of the whole batch before each of the two losses
+        copy_batch = lambda: (deepcopy(data), deepcopy(data))
+        view_batch = lambda: alg.batch_view(data)
+        print('{:>10} | {:>14.1f} {:>10.1f} | {:>14.1f} {:>10.1f}'.format(
+            batch_size, allocated_bytes(data, copy_batch) / 1024, timed(copy_batch),
+            allocated_bytes(data, view_batch) / 1024, timed(view_batch)))
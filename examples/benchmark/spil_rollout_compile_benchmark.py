@@ -0,0 +1,53 @@
+#  Copyright (c). All Rights Reserved.
+#  General Optimal control Problem Solver (GOPS)
+#  Intelligent Driving Lab(iDLab), Tsinghua University
+#
+#  Creator: Baiyu Peng
+#  Description: Eager vs. torch.compile horizon rollout of SPIL (policy + environment model)
+
+
+import os
+import sys
+import time
+
+import torch
+
+gops_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..')
+sys.path.insert(0, gops_path)
+
+import modules.create_pkg
+from modules.algorithm.spil import SPIL
+from spil_batch_copy_benchmark import ARGS, replay_batch
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+
+def time_rollout(alg, data, backward, repeat=20, warmup=3):
+    def run():
+        if backward:
+            alg.networks.policy.zero_grad()
+            r_sum, c_mul, _, _, _ = alg.rollout_fn(data['obs'], data['done'])
+            (r_sum.mean() + c_mul.mean()).backward()
+        else:
+            with torch.no_grad():
+                alg.rollout_fn(data['obs'], data['done'])
+
+    for _ in range(warmup):  # includes compilation
+        run()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) / repeat * 1000  # ms
+
+
+if __name__ == "__main__":
+    eager = SPIL(**ARGS)
+    compiled = SPIL(**dict(ARGS, compile_rollout=True))
+    compiled.networks.load_state_dict(eager.networks.state_dict())
+    print('{:>8} {:>10} | {:>10} {:>10}'.format('batch', 'mode', 'eager[ms]', 'compiled[ms]'))
+    for batch_size in [256, 1024, 4096]:
+        data = replay_batch(batch_size)
+        for backward in [False, True]:
+            print('{:>8} {:>10} | {:>10.2f} {:>10.2f}'.format(
+                batch_size, 'fwd+bwd' if backward else 'fwd',
+                time_rollout(eager, data, backward), time_rollout(compiled, data, backward)))
@@ -46,6 +46,10 @@ if __name__ == "__main__":
     parser.add_argument('--action_type', type=str, default='continu')
     parser.add_argument('--is_render', type=bool, default=not True)
     parser.add_argument('--is_adversary', type=bool, default=False)
+    parser.add_argument('--n_obstacle', type=int, default=1, help='number of moving obstacles')
+    parser.add_argument('--noise_seed', type=int, default=None, help='seed of the environment model noise')
+    parser.add_argument('--bound_check', type=str, default='always', help='always / sampled / entry / trusted')
+    parser.add_argument('--bound_check_interval', type=int, default=10, help='model calls between sampled bound checks')
 
 
     ################################################
@@ -70,6 +74,15 @@ if __name__ == "__main__":
     # 3. Parameters for RL algorithm
     parser.add_argument('--value_learning_rate', type=float, default=2e-3)
     parser.add_argument('--policy_learning_rate', type=float, default=0.3e-3)
+    parser.add_argument('--shared_rollout', type=bool, default=True, help='one model rollout for critic and actor losses')
+    parser.add_argument('--checkpoint_segment', type=int, default=0, help='rollout steps per checkpointed segment, 0 to disable')
+    parser.add_argument('--chance_replicates', type=int, default=1, help='noise replicates per state for the safety labels')
+    parser.add_argument('--micro_batch_size', type=int, default=0, help='accumulate gradients over micro-batches, 0 to disable')
+    parser.add_argument('--micro_batch_threads', type=int, default=1, help='threads computing micro-batches')
+    parser.add_argument('--v_update_interval', type=int, default=1, help='iterations between value net updates')
+    parser.add_argument('--prob_update_interval', type=int, default=1, help='iterations between probability net updates')
+    parser.add_argument('--lamnet_update_interval', type=int, default=1, help='iterations between lambda net updates')
+    parser.add_argument('--policy_update_interval', type=int, default=1, help='iterations between policy updates')
 
     # 4. Parameters for trainer
     parser.add_argument('--trainer', type=str, default='off_serial_trainer')
@@ -81,6 +94,11 @@ if __name__ == "__main__":
         parser.add_argument('--buffer_name', type=str, default='replay_buffer')
         parser.add_argument('--buffer_warm_size', type=int, default=1000)
         parser.add_argument('--buffer_max_size', type=int, default=400*1000)
+        parser.add_argument('--buffer_dir', type=str, default=None, help='memmap_replay_buffer: directory of the buffer files, reopened if it exists')
+        parser.add_argument('--sample_out_ring', type=int, default=0, help='reusable replay batches per buffer, 0 allocates')
+        parser.add_argument('--compact_buffer', type=bool, default=True, help='store only the fields the algorithm reads')
+        parser.add_argument('--dedup_obs2', type=bool, default=False, help='store each observation once, obs2 is rebuilt on sampling')
+        parser.add_argument('--buffer_dtypes', type=dict, default={}, help="storage dtype per field, e.g. {'obs': 'float16'}")
         parser.add_argument('--replay_batch_size', type=int, default=1024)
         parser.add_argument('--sampler_sync_interval', type=int, default=1)
 
@@ -88,6 +106,7 @@ if __name__ == "__main__":
     # 5. Parameters for sampler
     parser.add_argument('--sampler_name', type=str, default='off_sampler')
     parser.add_argument('--sample_batch_size', type=int, default=256)
+    parser.add_argument('--sample_agents', type=int, default=1, help='robots stepped together by each sampler')
     parser.add_argument('--noise_params', type=dict,
                         default={'mean': np.array([0, 0], dtype=np.float32),
                                  'std': np.array([0.05, 0.05], dtype=np.float32)})
@@ -17,15 +17,22 @@ from copy import deepcopy
 import torch
 import torch.nn as nn
 from torch.optim import Adam
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 from modules.create_pkg.create_apprfunc import create_apprfunc
 from modules.create_pkg.create_env_model import create_env_model
 from modules.utils.utils import get_apprfunc_dict
 from modules.utils.tensorboard_tools import tb_tags
 from modules.utils.utils import get_activation_func
+from modules.trainer.buffer.replay_buffer import buffer_fields, unpack_batch
 
 
 def mlp(sizes, activation, output_activation=nn.Identity):
@@ -65,6 +72,63 @@ class Prob(nn.Module):
         return v
 
 
+class SPILController(nn.Module):
+    """
+    Separated PI controller of the penalty weight lambda. It lives with the central networks: learners report
+    the safe probability of their batch in grad_info, the driver aggregates report_window reports per
+    controller step, and lambda reaches the learners inside the state_dict broadcast with the weights.
+    """
+    def __init__(self, constraint_dim, report_window=1):
+        super().__init__()
+        self.Kp = 40
+        self.Ki = 0.07
+        self.Kd = 0
+        self.report_window = report_window
+        self.register_buffer('chance_thre', torch.Tensor([0.99] * constraint_dim))
+        self.register_buffer('lam', torch.zeros(constraint_dim))
+        self.register_buffer('delta_i', torch.zeros(constraint_dim))
+        self.register_buffer('safe_prob_pre', torch.zeros(constraint_dim))
+        self.register_buffer('safe_prob_sum', torch.zeros(constraint_dim))
+        self.register_buffer('n_report', torch.zeros((), dtype=torch.long))
+
+    def report(self, safe_prob):
+        self.safe_prob_sum += torch.as_tensor(safe_prob, dtype=torch.float32)
+        self.n_report += 1
+        if self.n_report >= self.report_window:
+            self.step(self.safe_prob_sum / self.n_report)
+            self.safe_prob_sum.zero_()
+            self.n_report.zero_()
+
+    def step(self, safe_prob):
+        delta_p = (self.chance_thre - safe_prob)
+        # integral separation
+        delta_p_sepa = torch.where(torch.abs(delta_p) > 0.1, delta_p * 0.7, delta_p)
+        delta_p_sepa = torch.where(torch.abs(delta_p) > 0.2, delta_p * 0, delta_p_sepa)
+        self.delta_i.copy_(torch.clamp(self.delta_i + delta_p_sepa, 0, 99999))
+
+        delta_d = torch.clamp(self.safe_prob_pre - safe_prob, 0, 3333)
+        lam = torch.clamp(self.Ki * self.delta_i + self.Kp * delta_p + self.Kd * delta_d, 0, 3333)
+        self.safe_prob_pre.copy_(safe_prob)
+        self.lam.copy_(lam *0 +0.)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the controller moved into the networks carry no controller state
+        if any(k.startswith(prefix) for k in state_dict):
+            super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def fused_adam(params, lr):
+    """
+    Adam whose step runs as multi-tensor (foreach) kernels over the whole parameter group
+    instead of a Python loop over the parameters.
+    """
+    try:
+        return Adam(params, lr=lr, foreach=True)
+    except TypeError:  # torch < 1.12 only ships the multi-tensor variant separately
+        from torch.optim._multi_tensor import Adam as MultiTensorAdam
+        return MultiTensorAdam(params, lr=lr)
+
+
 class ApproxContainer(nn.Module):
     def __init__(self, **kwargs):
         super().__init__()
@@ -85,6 +149,9 @@ class ApproxContainer(nn.Module):
         self.prob = Prob(prob_args)
         self.lamnet = Lambda(lamnet_args)
 
+        self.controller = SPILController(kwargs['constraint_dim'],
+                                         kwargs.get('controller_report_window', kwargs.get('num_algs', 1)))
+
         self.v_target = deepcopy(self.v)
         self.policy_target = deepcopy(self.policy)
         self.prob_target = deepcopy(self.prob)
@@ -99,18 +166,27 @@ class ApproxContainer(nn.Module):
         for p in self.lamnet_target.parameters():
             p.requires_grad = False
 
-        self.policy_optimizer = Adam(self.policy.parameters(), lr=kwargs['policy_learning_rate'])  #
-        self.v_optimizer = Adam(self.v.parameters(), lr=kwargs['value_learning_rate'])
-        self.prob_optimizer = Adam(self.prob.parameters(), lr=2e-2)
-        self.lamnet_optimizer = Adam(self.lamnet.parameters(), lr=2e-3)
+        self.fused_update = kwargs.get('fused_update', True)
+        optimizer_cls = fused_adam if self.fused_update else Adam
+        self.policy_optimizer = optimizer_cls(self.policy.parameters(), lr=kwargs['policy_learning_rate'])  #
+        self.v_optimizer = optimizer_cls(self.v.parameters(), lr=kwargs['value_learning_rate'])
+        self.prob_optimizer = optimizer_cls(self.prob.parameters(), lr=2e-2)
+        self.lamnet_optimizer = optimizer_cls(self.lamnet.parameters(), lr=2e-3)
 
         self.net_dict = {'v': self.v, 'policy': self.policy, 'prob':self.prob, 'lamnet':self.lamnet}
         self.target_net_dict = {'v': self.v_target, 'policy': self.policy_target, 'prob':self.prob_target, 'lamnet':self.lamnet_target}
         self.optimizer_dict = {'v': self.v_optimizer, 'policy': self.policy_optimizer, 'prob':self.prob_optimizer, 'lamnet':self.lamnet_optimizer}
+        self.param_dict = {k: list(net.parameters()) for k, net in self.net_dict.items()}
+        self.target_param_dict = {k: list(net.parameters()) for k, net in self.target_net_dict.items()}
 
     def update(self, grad_info):
         tau = grad_info['tau']
         grads_dict = grad_info['grads_dict']
+        if 'safe_prob' in grad_info:
+            self.controller.report(grad_info['safe_prob'])
+        if self.fused_update:
+            self.fused_step(grads_dict, tau)
+            return
         for net_name, grads in grads_dict.items():
             for p, grad in zip(self.net_dict[net_name].parameters(), grads):
                 p.grad = grad
@@ -122,7 +198,24 @@ class ApproxContainer(nn.Module):
                     p_targ.data.mul_(1-tau)
                     p_targ.data.add_(tau * p.data)
 
+    def fused_step(self, grads_dict, tau):
+        params, target_params = [], []
+        for net_name, grads in grads_dict.items():
+            for p, grad in zip(self.param_dict[net_name], grads):
+                p.grad = grad
+            self.optimizer_dict[net_name].step()
+            params += self.param_dict[net_name]
+            target_params += self.target_param_dict[net_name]
+
+        # Polyak averaging of every updated target net at once
+        with torch.no_grad():
+            torch._foreach_mul_(target_params, 1 - tau)
+            torch._foreach_add_(target_params, params, alpha=tau)
+
 class SPIL:
+    # replay fields read by the losses, everything else is regenerated by the environment model
+    batch_keys = ('obs', 'done')
+
     def __init__(self, **kwargs):
         self.networks = ApproxContainer(**kwargs)
         self.envmodel = create_env_model(**kwargs)
@@ -135,9 +228,33 @@ class SPIL:
         self.pim_step = 1
         self.forward_step = 25
         self.reward_scale = 0.02
+        # one differentiable model rollout feeds both critic and actor losses
+        self.shared_rollout = kwargs.get('shared_rollout', True)
+        # fuse the horizon loop (policy, model dynamics, reward and constraint) into one compiled graph
+        self.compile_rollout = kwargs.get('compile_rollout', False)
+        self.compiled_rollout = None
+        # recompute the differentiable rollout in segments of this many steps during backward, 0 keeps every step
+        self.checkpoint_segment = kwargs.get('checkpoint_segment', 0)
+        # noise replicates of every start state in the rollout that labels the critics
+        self.chance_replicates = kwargs.get('chance_replicates', 1)
+        # split large replay batches into micro-batches whose gradients are accumulated, 0 disables
+        self.micro_batch_size = kwargs.get('micro_batch_size', 0)
+        self.micro_batch_threads = kwargs.get('micro_batch_threads', 1)
+        # layout of the packed replay batches, see ReplayBuffer.sample_batch_packed
+        self.buffer_fields = buffer_fields(**kwargs)
+        self.micro_batch_pool = ThreadPoolExecutor(self.micro_batch_threads) if self.micro_batch_threads > 1 else None
+        # update every head (v, policy, prob, lamnet) once per this many iterations
+        self.update_interval = {'v': kwargs.get('v_update_interval', 1),
+                                'prob': kwargs.get('prob_update_interval', 1),
+                                'lamnet': kwargs.get('lamnet_update_interval', 1),
+                                'policy': kwargs.get('policy_update_interval', 1)}
+        if self.compile_rollout:
+            if hasattr(torch, 'compile'):
+                self.compiled_rollout = torch.compile(self.rollout, dynamic=False)
+            else:
+                warnings.warn('torch.compile is not available (torch < 2.0), the rollout runs eagerly')
 
         self.n_constraint = kwargs['constraint_dim']
-        self.delta_i = np.array([0.] * kwargs['constraint_dim'])
 
         self.Kp = 40
         self.Ki = 0.07
@@ -146,7 +263,6 @@ class SPIL:
         self.tb_info = dict()
 
         self.chance_thre = torch.Tensor([0.99] * kwargs['constraint_dim'])
-        self.safe_prob_pre = np.array([0.] * kwargs['constraint_dim'])
 
     def set_parameters(self, param_dict):
         for key in param_dict:
@@ -165,6 +281,13 @@ class SPIL:
         params['pim_step'] = self.pim_step
         params['reward_scale'] = self.reward_scale
         params['forward_step'] = self.forward_step
+        params['shared_rollout'] = self.shared_rollout
+        params['compile_rollout'] = self.compile_rollout
+        params['checkpoint_segment'] = self.checkpoint_segment
+        params['chance_replicates'] = self.chance_replicates
+        params['update_interval'] = self.update_interval
+        params['micro_batch_size'] = self.micro_batch_size
+        params['micro_batch_threads'] = self.micro_batch_threads
         return params
 
     def compute_gradient(self, data, iteration):
@@ -172,38 +295,63 @@ class SPIL:
         grads_dict = dict()
 
         start_time = time.time()
+        # penalty weight broadcast by the central controller together with the weights
+        self.lam = self.networks.controller.lam
+        self.safe_prob = None
         if self.use_gpu:
             self.networks = self.networks.cuda()
-            for key, value in data.items():
-                data[key] = value.cuda()
-
-        # if iteration % (self.pev_step + self.pim_step) < self.pev_step: ##TODO: 这里改成了每个iteration都包含pev和pim
-        self.networks.v.zero_grad()
-        loss_v, v, loss_prob, prob, loss_lamnet, lamnet = self.compute_loss_v(deepcopy(data))
-        loss_v.backward(); loss_prob.backward(); loss_lamnet.backward()
-        v_grad = [p.grad for p in self.networks.v.parameters()]
-        self.tb_info[tb_tags["loss_critic"]] = loss_v.item()
-        self.tb_info[tb_tags["critic_avg_value"]] = v.item()
-        grads_dict['v'] = v_grad
-        grads_dict['prob'] = [p.grad for p in self.networks.prob.parameters()]
-        grads_dict['lamnet'] = [p.grad for p in self.networks.lamnet.parameters()]
-        # else:
-        self.networks.policy.zero_grad()
-        loss_policy = self.compute_loss_policy(deepcopy(data))
-        loss_policy.backward()
-        policy_grad = [p.grad for p in self.networks.policy.parameters()]
-        self.tb_info[tb_tags["loss_actor"]] = loss_policy.item()
-        grads_dict['policy'] = policy_grad
+        data = self.batch_view(data)
+        # the obstacles ignore the ego robot, their trajectories are shared by all rollouts of the batch
+        data['obs_traj'] = self.envmodel.obstacle_trajectory(data['obs'], self.forward_step)
+
+        # heads updated at this iteration, the rollouts and backward passes of the others are skipped
+        heads = [k for k, interval in self.update_interval.items() if iteration % interval == 0]
+        loss_v = loss_policy = None
+        if self.micro_batch_size and data['obs'].shape[0] > self.micro_batch_size:
+            loss_v, v, loss_prob, prob, loss_lamnet, lamnet, loss_policy, grads_dict = \
+                self.accumulate_micro_batches(data, heads)
+        else:
+            self.networks.zero_grad()
+            losses = dict()
+            rollout_start = time.time()
+            if self.shared_rollout:
+                loss_v, v, loss_prob, prob, loss_lamnet, lamnet, loss_policy = \
+                    self.compute_loss_shared(data, track_policy='policy' in heads)
+                losses.update(v=loss_v, prob=loss_prob, lamnet=loss_lamnet, policy=loss_policy)
+            elif set(heads) - {'policy'}:
+                loss_v, v, loss_prob, prob, loss_lamnet, lamnet = self.compute_loss_v(data)
+                losses.update(v=loss_v, prob=loss_prob, lamnet=loss_lamnet)
+            self.tb_info[tb_tags["rollout_time"]] = (time.time() - rollout_start) * 1000  # ms
+
+            # the losses touch disjoint parameter sets and the critic losses see a detached rollout,
+            # so one backward per head costs no more than a single joint backward
+            for head in heads:
+                head_start = time.time()
+                if head == 'policy' and not self.shared_rollout:
+                    loss_policy = self.compute_loss_policy(data)
+                    losses['policy'] = loss_policy
+                losses[head].backward()
+                grads_dict[head] = [p.grad for p in self.networks.param_dict[head]]
+                self.tb_info[tb_tags[head + "_time"]] = (time.time() - head_start) * 1000  # ms
+        if loss_v is not None:
+            self.tb_info[tb_tags["loss_critic"]] = loss_v.item()
+            self.tb_info[tb_tags["critic_avg_value"]] = v.item()
+        if loss_policy is not None:
+            self.tb_info[tb_tags["loss_actor"]] = loss_policy.item()
 
         if self.use_gpu:
             self.networks = self.networks.cpu()
-            for key, value in data.items():
-                data[key] = value.cpu()
 
         end_time = time.time()
         self.tb_info[tb_tags["alg_time"]] = (end_time - start_time) * 1000  # ms
-        self.tb_info[tb_tags["safe_probability1"]] = self.safe_prob
-        self.tb_info[tb_tags["lambda1"]] = self.lam.item() #lamnet
+        if resource is not None:
+            self.tb_info[tb_tags["learner_peak_rss"]] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # MB
+        if self.safe_prob is not None:
+            self.tb_info[tb_tags["safe_probability1"]] = self.safe_prob[0].item()
+        self.tb_info[tb_tags["state_clip_events"]] = self.envmodel.clip_events['state']
+        self.tb_info[tb_tags["action_clip_events"]] = self.envmodel.clip_events['action']
+        self.envmodel.clip_events = {'state': 0, 'action': 0}
+        self.tb_info[tb_tags["lambda1"]] = self.lam[0].item() #lamnet
         #self.tb_info[tb_tags["safe_probability2"]] = self.safe_prob[1].item()
         # self.tb_info[tb_tags["lambda2"]] = self.lam[1].item()
 
@@ -212,6 +360,8 @@ class SPIL:
 
         grad_info['tau'] = self.tau
         grad_info['grads_dict'] = grads_dict
+        if self.safe_prob is not None:
+            grad_info['safe_prob'] = self.safe_prob
         return grad_info, self.tb_info
 
         # tb_info[tb_tags["loss_critic"]] = loss_v.item()
@@ -220,78 +370,188 @@ class SPIL:
         # tb_info[tb_tags["loss_actor"]] = loss_policy.item()
         # return v_grad + policy_grad, tb_info
 
+    def batch_view(self, data):
+        """
+        Read-only view of the replay batch restricted to batch_keys. The losses rebind their local
+        variables instead of writing into the batch, so the tensors are shared, not copied.
+        A packed batch is viewed field by field, also without a copy.
+        """
+        if isinstance(data, np.ndarray):
+            data = unpack_batch(data, self.buffer_fields)
+        if self.use_gpu:
+            return {k: data[k].cuda(non_blocking=True) for k in self.batch_keys}
+        return {k: data[k] for k in self.batch_keys}
+
     def compute_loss_v(self, data):
-        o, a, r, c, o2, d = data['obs'], data['act'], data['rew'], data['con'], data['obs2'], data['done']
-        v = self.networks.v(o)
-        prob = self.networks.prob(o)
-        lamnet = self.networks.lamnet(o)
-        traj_issafe = torch.ones(o.shape[0], self.n_constraint)
+        with torch.no_grad():
+            r_sum, _, traj_issafe, o, o2 = self.rollout_replicates(data['obs'], data['done'], data['obs_traj'])
 
+        return self.compute_loss_critics(data['obs'], r_sum, traj_issafe, o, o2)
+
+    def compute_loss_critics(self, o_start, r_sum, traj_issafe, o, o2, report=True):
+        # o_start is the first state of the rollout, o the input of its last step and o2 its final state
+        v = self.networks.v(o_start)
+        prob = self.networks.prob(o_start)
+        lamnet = self.networks.lamnet(o_start)
         with torch.no_grad():
-            for step in range(self.forward_step):
-                if step == 0:
-                    a = self.networks.policy(o)
-                    o2, r, d, info = self.envmodel.forward(o, a, d)
-                    r_sum = self.reward_scale * r
-                    traj_issafe *= torch.where(info['constraint'] > 0, 0, 1)
-
-                else:
-                    o = o2
-                    a = self.networks.policy(o)
-                    o2, r, d, info = self.envmodel.forward(o, a, d)
-                    r_sum += self.reward_scale * self.gamma ** step * r
-                    traj_issafe *= torch.where(info['constraint']>0, 0, 1)
-
-            r_sum += self.gamma ** self.forward_step * self.networks.v_target(o2)
+            r_sum = r_sum + self.gamma ** self.forward_step * self.networks.v_target(o2)
+            prob_target, lamnet_target = self.networks.prob_target(o), self.networks.lamnet_target(o)
+            if self.chance_replicates > 1:
+                # per start state means over the noise replicates
+                r_sum, traj_issafe, prob_target, lamnet_target = [
+                    x.view(o_start.shape[0], self.chance_replicates, *x.shape[1:]).mean(1)
+                    for x in (r_sum, traj_issafe, prob_target, lamnet_target)]
         loss_v = ((v - r_sum) ** 2).mean()
         loss_prob = ((prob - traj_issafe) ** 2).mean()
 
-        delta_p = (self.chance_thre - self.networks.prob_target(o))
+        delta_p = (self.chance_thre - prob_target)
         delta_p_sepa = torch.where(torch.abs(delta_p) > 0.1, delta_p * 0.7, delta_p)
         delta_p_sepa = torch.where(torch.abs(delta_p) > 0.2, delta_p * 0.1, delta_p_sepa)
-        delta_i = torch.clamp(self.networks.lamnet_target(o) + delta_p_sepa, 0, 99999)
+        delta_i = torch.clamp(lamnet_target + delta_p_sepa, 0, 99999)
         #delta_d = np.clip(self.safe_prob_pre - self.safe_prob, 0, 3333)
         lam_target = torch.clamp(self.Ki * delta_i + 0*self.Kp * delta_p, 0, 3333)
         loss_lamnet = ((lamnet - lam_target) ** 2).mean()
 
-        safe_prob = (traj_issafe).mean(0).numpy()
+        if report:
+            safe_prob = (traj_issafe).mean(0).numpy()
 
-        # Non-NN
-        self.safe_prob = safe_prob
+            # Non-NN
+            self.safe_prob = safe_prob
 
-        print('Reward:', r_sum.mean(), 'safe probability', safe_prob)
+            print('Reward:', r_sum.mean(), 'safe probability', safe_prob)
         return loss_v, torch.mean(v), loss_prob, torch.mean(prob), loss_lamnet, torch.mean(lamnet)
 
     def compute_loss_policy(self, data):
-        o, a, r, c, o2, d = data['obs'], data['act'], data['rew'], data['con'], data['obs2'], data['done']  # TODO  解耦字典
-        for step in range(self.forward_step):
-            if step == 0:
-                a = self.networks.policy(o)
-                o2, r, d, info = self.envmodel.forward(o, a, d)
-                c = info['constraint']
-                c = self.Phi(c)
-                r_sum = self.reward_scale * r
-                c_sum = c
-                c_mul = c
-            else:
-                o = o2
-                a = self.networks.policy(o)
-                o2, r, d, info = self.envmodel.forward(o, a, d)
-                c = info['constraint']
-                c = self.Phi(c)
-                r_sum = r_sum + self.reward_scale * self.gamma ** step * r
-                c_sum = c_sum + c
-                c_mul = c_mul * c
+        r_sum, c_mul, _, _, _ = self.rollout_fn(data['obs'], data['done'], data['obs_traj'])
         #r_sum += self.gamma ** self.forward_step * self.networks.v_target(o2)
-        lam = self.networks.lamnet_target(o)
+        return self.compute_loss_pi(r_sum, c_mul)
+
+    def compute_loss_pi(self, r_sum, c_mul):
         # for non-NN
-        self.spil_get_weight()
-        lam = torch.Tensor(self.lam).reshape(1,1)
+        return self.policy_loss(r_sum, c_mul, self.lam)
+
+    def policy_loss(self, r_sum, c_mul, lam):
+        lam = lam.reshape(1, -1)
 
         w_r, w_c = 1 / (1 + lam.sum(1)), lam / (1 + lam.sum(1).unsqueeze(1))
         loss_pi = (r_sum * w_r + (c_mul*w_c).sum(1)).mean()
         return -loss_pi
 
+    def compute_loss_shared(self, data, track_policy=True):
+        # Roll the model out once with autograd enabled; the critic targets and the safety labels are read
+        # off the same trajectory with the graph detached, the actor loss backpropagates through it.
+        # Without track_policy the rollout records no graph, the actor loss is then only a statistic.
+        with torch.set_grad_enabled(track_policy):
+            r_sum, c_mul, traj_issafe, o, o2 = self.rollout_replicates(data['obs'], data['done'], data['obs_traj'])
+        loss_v, v, loss_prob, prob, loss_lamnet, lamnet = self.compute_loss_critics(
+            data['obs'], r_sum.detach(), traj_issafe, o.detach(), o2.detach())
+        loss_policy = self.compute_loss_pi(r_sum, c_mul)
+        return loss_v, v, loss_prob, prob, loss_lamnet, lamnet, loss_policy
+
+    def accumulate_micro_batches(self, data, heads):
+        """
+        Gradients of the whole batch accumulated over micro-batches of micro_batch_size, so that the peak
+        memory is that of one micro-batch rollout.
+        """
+        batch_size = data['obs'].shape[0]
+        chunks = [{k: v[i:i + self.micro_batch_size] for k, v in data.items()}
+                  for i in range(0, batch_size, self.micro_batch_size)]
+        weights = [chunk['obs'].shape[0] / batch_size for chunk in chunks]
+        if self.micro_batch_pool is not None:
+            results = list(self.micro_batch_pool.map(self.compute_micro_batch, chunks, weights, [heads] * len(chunks)))
+        else:
+            results = [self.compute_micro_batch(chunk, weight, heads) for chunk, weight in zip(chunks, weights)]
+
+        stats = [sum(w * r[0][i] for w, r in zip(weights, results)) for i in range(len(results[0][0]))]
+        grads = [sum(g) for g in zip(*[r[1] for r in results])]
+        grads_dict = dict()
+        for net_name in heads:
+            n_param = len(self.networks.param_dict[net_name])
+            grads_dict[net_name], grads = grads[:n_param], grads[n_param:]
+
+        loss_v, v, loss_prob, prob, loss_lamnet, lamnet, loss_policy, r_sum, safe_prob = stats
+        self.safe_prob = safe_prob.numpy()
+        print('Reward:', r_sum, 'safe probability', self.safe_prob)
+        return loss_v, v, loss_prob, prob, loss_lamnet, lamnet, loss_policy, grads_dict
+
+    def compute_micro_batch(self, chunk, weight, heads):
+        # no side effects on the algorithm, micro-batches may run in parallel threads
+        o, d, obs_traj = chunk['obs'], chunk['done'], chunk['obs_traj']
+        if self.shared_rollout:
+            with torch.set_grad_enabled('policy' in heads):
+                r_sum, c_mul, traj_issafe, o_last, o2 = self.rollout_replicates(o, d, obs_traj)
+            losses = self.compute_loss_critics(o, r_sum.detach(), traj_issafe, o_last.detach(), o2.detach(),
+                                               report=False)
+        else:
+            with torch.no_grad():
+                r_sum, c_mul, traj_issafe, o_last, o2 = self.rollout_replicates(o, d, obs_traj)
+            losses = self.compute_loss_critics(o, r_sum, traj_issafe, o_last, o2, report=False)
+            if 'policy' in heads:
+                r_sum, c_mul, _, _, _ = self.rollout_fn(o, d, obs_traj)
+        loss_v, v, loss_prob, prob, loss_lamnet, lamnet = losses
+        loss_policy = self.policy_loss(r_sum, c_mul, self.lam)
+
+        head_losses = {'v': loss_v, 'prob': loss_prob, 'lamnet': loss_lamnet, 'policy': loss_policy}
+        params = [p for net_name in heads for p in self.networks.param_dict[net_name]]
+        grads = torch.autograd.grad(weight * sum(head_losses[net_name] for net_name in heads), params,
+                                    allow_unused=True)
+        grads = [torch.zeros_like(p) if g is None else g for p, g in zip(params, grads)]
+        stats = [x.detach() for x in (loss_v, v, loss_prob, prob, loss_lamnet, lamnet, loss_policy,
+                                      r_sum.mean(), traj_issafe.mean(0))]
+        return stats, grads
+
+    def rollout(self, o, d, noise, obs_traj):
+        """
+        Run the policy through the environment model for forward_step steps, step i perturbed by noise[i],
+        the obstacles following obs_traj.
+        Returns the discounted reward sum, the product of Phi(constraint), the 0/1 safety of the whole
+        trajectory, the input state of the last step and the final state.
+        """
+        r_sum = torch.zeros(o.shape[0])
+        c_mul = torch.ones(o.shape[0], self.n_constraint)
+        traj_issafe = torch.ones(o.shape[0], self.n_constraint)
+        if not (self.checkpoint_segment and torch.is_grad_enabled()):
+            o_last, o, d, r_sum, c_mul, traj_issafe = self.rollout_steps(
+                0, self.forward_step, noise, obs_traj, o, d, r_sum, c_mul, traj_issafe)
+            return r_sum, c_mul, traj_issafe, o_last, o
+
+        # Only the segment boundaries are kept for backward, the steps in between are recomputed.
+        # The noise is an input of the segment, so the recomputation replays the same trajectory.
+        for start in range(0, self.forward_step, self.checkpoint_segment):
+            stop = min(start + self.checkpoint_segment, self.forward_step)
+            o_last, o, d, r_sum, c_mul, traj_issafe = checkpoint(
+                self.rollout_steps, start, stop, noise, obs_traj, o, d, r_sum, c_mul, traj_issafe, use_reentrant=False)
+        return r_sum, c_mul, traj_issafe, o_last, o
+
+    def rollout_steps(self, start, stop, noise, obs_traj, o, d, r_sum, c_mul, traj_issafe):
+        out = self.envmodel.forward_n_step(self.networks.policy, stop - start, o, d, gamma=self.gamma, phi=self.Phi,
+                                           noise=noise[start:stop], start_step=start, obs_traj=obs_traj[:, start:stop])
+        return out['last_state'], out['state'], out['done'][-1], r_sum + self.reward_scale * out['reward_sum'], \
+            c_mul * out['constraint_mul'], traj_issafe * out['is_safe']
+
+    def rollout_replicates(self, o, d, obs_traj=None):
+        # chance_replicates copies of every start state, adjacent rows, in one batched rollout
+        if obs_traj is None:
+            obs_traj = self.envmodel.obstacle_trajectory(o, self.forward_step)
+        if self.chance_replicates > 1:
+            o, d = o.repeat_interleave(self.chance_replicates, 0), d.repeat_interleave(self.chance_replicates, 0)
+            obs_traj = obs_traj.repeat_interleave(self.chance_replicates, 0)
+        return self.rollout_fn(o, d, obs_traj)
+
+    def rollout_fn(self, o, d, obs_traj=None):
+        # the noise of the whole horizon in one draw, outside of the compiled graph and the checkpoints
+        noise = self.envmodel.sample_noise(self.forward_step, o.shape[0])
+        if obs_traj is None:
+            obs_traj = self.envmodel.obstacle_trajectory(o, self.forward_step)
+        o = self.envmodel.check_entry(o)
+        if self.compiled_rollout is not None:
+            try:
+                return self.compiled_rollout(o, d, noise, obs_traj)
+            except Exception as e:
+                warnings.warn('compiled rollout failed, falling back to eager: {}'.format(e))
+                self.compiled_rollout = None
+        return self.rollout(o, d, noise, obs_traj)
+
     def Phi(self, y):
         # Transfer constraint to cumulative
         m1 = 1
@@ -312,19 +572,6 @@ class SPIL:
     def load_state_dict(self, state_dict):
         self.networks.load_state_dict(state_dict)
 
-    def spil_get_weight(self):
-        delta_p = (self.chance_thre.numpy() - self.safe_prob)
-        # integral separation
-        delta_p_sepa = np.where(np.abs(delta_p) > 0.1, delta_p * 0.7, delta_p)
-        delta_p_sepa = np.where(np.abs(delta_p) > 0.2, delta_p * 0, delta_p_sepa)
-        self.delta_i = np.clip(self.delta_i + delta_p_sepa, 0, 99999)
-
-        delta_d = np.clip(self.safe_prob_pre - self.safe_prob, 0, 3333)
-        lam = np.clip(self.Ki * self.delta_i + self.Kp * delta_p + self.Kd * delta_d, 0, 3333)
-        self.safe_prob_pre = self.safe_prob
-        self.lam = lam *0 +0.
-
-
 
 if __name__ == '__main__':
     print('11111')
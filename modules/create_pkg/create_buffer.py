@@ -28,7 +28,8 @@ def create_buffer(**kwargs):
             if trainer == 'off_serial_trainer':
                 buffer = buffer_cls(**kwargs)
             elif trainer == 'off_async_trainer':
-                buffer = [ray.remote(num_cpus=1)(ReplayBuffer).remote(**kwargs) for _ in range(kwargs['num_buffers'])]
+                buffer = [ray.remote(num_cpus=1)(buffer_cls).remote(**kwargs, buffer_index=i)
+                          for i in range(kwargs['num_buffers'])]
             else:
                 raise NotImplementedError("This trainer is not properly defined")
 
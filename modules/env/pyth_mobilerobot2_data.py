@@ -23,7 +23,7 @@ class PythMobilerobot2:
         """
         you need to define parameters here
         """
-        self.n_obstacle = 1
+        self.n_obstacle = kwargs.get('n_obstacle', 1)
 
         self.robot = Robot()
         self.obses = [Robot() for _ in range(self.n_obstacle)]
@@ -43,8 +43,12 @@ class PythMobilerobot2:
         self.action_space = spaces.Box(low=lb_action, high=hb_action)
         self.observation_space = spaces.Box(lb_state, hb_state)
 
+        # vector env mode: the agents that finished are reset in place at the end of step, see step
+        self.auto_reset = kwargs.get('auto_reset', False)
+        self.max_episode_steps = 170
+
         self.seed()
-        self.steps = 0
+        self.steps = np.zeros(1, dtype=np.int64)
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
@@ -84,22 +88,33 @@ class PythMobilerobot2:
         isdone = collision.all(1) + (self.state[:, 0] < -2) + (self.state[:, 0] > 13) + (self.state[:, 1] > 3) + (self.state[:, 1] < -3)
         ############################################################################################
         self.steps += 1
-        info = {'TimeLimit.truncated': self.steps > 170, 'constraint': constraint}
+        truncated = self.steps > self.max_episode_steps
+        info = {'TimeLimit.truncated': truncated, 'constraint': constraint}
+        if self.auto_reset:
+            # as in gym vector envs, the returned state of a finished agent is already its reset state,
+            # the state it ended in is kept in info['terminal_state']
+            finished = isdone | truncated
+            info['finished'] = finished
+            if finished.any():
+                info['terminal_state'] = state_next[finished].copy()
+                self.reset_agents(finished)
         return state_next, reward, isdone, info
 
-    # def forward_n_step(self, func, n, state: torch.Tensor):
-    #     reward = torch.zeros(size=[state.size()[0], n])
-    #     isdone = state.numpy() <= self.hb_state | state.numpy() >= self.lb_state
-    #     if np.sum(isdone) > 0:
-    #         warning_msg = "state out of state space!"
-    #         warnings.warn(warning_msg)
-    #     isdone = torch.from_numpy(isdone)
-    #     for step in range(n):
-    #         action = func(state)
-    #         state_next, reward[:, step], isdone = self.forward(state, action, isdone)
-    #         state = state_next
-
     def reset(self, n_agent=1):
+        self.steps_beyond_done = None
+        self.steps = np.zeros(n_agent, dtype=np.int64)
+        self.state = self.initial_state(n_agent)
+
+        return self.state
+
+    def reset_agents(self, mask):
+        """
+        Reset only the agents selected by the boolean mask, in place.
+        """
+        self.state[mask] = self.initial_state(int(mask.sum()))
+        self.steps[mask] = 0
+
+    def initial_state(self, n_agent):
         def uniform(low, high):
             return np.random.random([n_agent]) *(high-low) + low
 
@@ -120,10 +135,6 @@ class PythMobilerobot2:
                 state[:, 3 + 5 * i + 3] = uniform(0., 0.)
                 state[:, 3 + 5 * i + 4] = 0
 
-        self.steps_beyond_done = None
-        self.steps = 0
-        self.state = state
-
         return state
 
     def render(self, n_window=1):
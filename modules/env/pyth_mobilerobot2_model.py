@@ -13,17 +13,26 @@ import matplotlib.pyplot as plt
 
 class PythMobilerobot2Model:
 
-    def __init__(self):
+    def __init__(self, **kwargs):
         """
         you need to define parameters here
         """
-        self.n_obstacle = 1
+        self.n_obstacle = kwargs.get('n_obstacle', 1)
 
         self.robot = Robot()
         self.obses = [Robot() for _ in range(self.n_obstacle)]
+        # ego-obstacle distance below which the pair is in collision, one entry per obstacle
+        self.safe_dis = torch.tensor([self.robot.robot_params['radius'] + obs.robot_params['radius'] + 0.15
+                                      for obs in self.obses], dtype=torch.float32)  # 0.35
 
         # define common parameters here
         self.dt = 0.4  # seconds between state updates
+        # process noise is drawn from this generator, or from the global torch RNG without noise_seed
+        self.noise_seed = kwargs.get('noise_seed', None)
+        self.generator = None
+        if self.noise_seed is not None:
+            self.generator = torch.Generator()
+            self.generator.manual_seed(self.noise_seed)
 
         self.state_dim = (1+self.n_obstacle) * 5 + 3
         self.action_dim = 2
@@ -38,34 +47,86 @@ class PythMobilerobot2Model:
         self.lb_action = torch.tensor(self.lb_action, dtype=torch.float32)
         self.hb_action = torch.tensor(self.hb_action, dtype=torch.float32)
 
-    def forward(self, state: torch.Tensor, action: torch.Tensor, beyond_done: torch.Tensor):
+        # 'always': forward clips state and action at every call, 'sampled': every bound_check_interval-th call,
+        # 'entry': only check_entry at the start of a rollout, 'trusted': never
+        self.bound_check = kwargs.get('bound_check', 'always')
+        if self.bound_check not in ('always', 'sampled', 'entry', 'trusted'):
+            raise ValueError('unknown bound_check mode: {}'.format(self.bound_check))
+        self.bound_check_interval = kwargs.get('bound_check_interval', 10)
+        self.n_forward = 0
+        # number of checks that had to clip, read and reset by the algorithm
+        self.clip_events = {'state': 0, 'action': 0}
 
-        warning_msg = "action out of action space!"
-        if not ((action <= self.hb_action).all() and (action >= self.lb_action).all()):
-            warnings.warn(warning_msg)
+    def sample_noise(self, n_step, batch_size):
+        """
+        Ego process noise of a whole rollout in one draw, shape [n_step, batch_size, 2].
+        Step i of the rollout uses forward(..., noise=noise[i]).
+        """
+        return self.robot.sample_noise((n_step, batch_size), 'ego', self.generator)
+
+    def check_bounds(self, state, action=None):
+        """
+        Clip state (and action) into the state (and action) space, counting the checks that had to clip.
+        """
+        if action is not None and not ((action <= self.hb_action).all() and (action >= self.lb_action).all()):
+            self.clip_events['action'] += 1
             action = clip_by_tensor(action, self.lb_action, self.hb_action)
 
-        warning_msg = "state out of state space!"
         if not ((state <= self.hb_state).all() and (state >= self.lb_state).all()):
-            warnings.warn(warning_msg)
+            self.clip_events['state'] += 1
             state = clip_by_tensor(state, self.lb_state, self.hb_state)
+        return state, action
+
+    def check_entry(self, state):
+        """
+        Check of the initial state of a rollout, skipped only in the 'trusted' mode.
+        """
+        if self.bound_check == 'trusted':
+            return state
+        return self.check_bounds(state)[0]
+
+    def obstacle_trajectory(self, state, n):
+        """
+        Obstacle states after each of the next n steps, shape [batch, n, n_obstacle, 5], batch first so that
+        it can be sliced and replicated together with the initial states.
+        The obstacles follow their own noise-free velocities and do not react to the ego robot, so their
+        trajectories are fixed by the initial state and need no gradient.
+        """
+        traj = state.new_empty(state.shape[0], n, self.n_obstacle, 5)
+        with torch.no_grad():
+            obs_state = state[:, 8:].reshape(-1, 5)
+            for step in range(n):
+                if self.bound_check != 'trusted':
+                    obs_state = clip_by_tensor(obs_state, self.lb_state[8:13], self.hb_state[8:13])
+                obs_state = self.robot.f_xu(obs_state, obs_state[:, 3:5], self.dt, 'obs')
+                traj[:, step] = obs_state.reshape(state.shape[0], self.n_obstacle, 5)
+        return traj
+
+    def forward(self, state: torch.Tensor, action: torch.Tensor, beyond_done: torch.Tensor, noise=None, obs_next=None):
+
+        if self.bound_check == 'sampled':
+            # the call counter is only kept here, a mutated attribute recompiles a compiled rollout at every step
+            self.n_forward += 1
+        if self.bound_check == 'always' or \
+                (self.bound_check == 'sampled' and self.n_forward % self.bound_check_interval == 0):
+            state, action = self.check_bounds(state, action)
         ################################################################################################################
         #  define your forward function here: the format is just like: state_next = f(state,action)
-        veh2vehdist = torch.zeros(state.shape[0], self.n_obstacle)
-        for i in range(1+self.n_obstacle):
-            if i == 0:
-                robot_state = self.robot.f_xu(state[:, :5], action, self.dt, 'ego')
-                tracking_error = self.robot.tracking_error(robot_state)
-                state_next = torch.cat((robot_state, tracking_error), 1)
+        if noise is None:
+            noise = self.robot.sample_noise((state.shape[0],), 'ego', self.generator)
+        robot_state = self.robot.f_xu(state[:, :5], action, self.dt, 'ego', noise)
+        tracking_error = self.robot.tracking_error(robot_state)
 
-            else:
-                obs_state = self.robot.f_xu(state[:, 3+i*5:3+i*5+5], state[:, 3+i*5+3:3+i*5+5], self.dt, 'obs')
-                state_next = torch.cat((state_next, obs_state), 1)
-
-                safe_dis = self.robot.robot_params['radius'] + self.obses[i-1].robot_params['radius'] + 0.15  # 0.35
-                veh2vehdist[:,i-1] = safe_dis - (
-                    torch.sqrt(torch.square(state_next[:, 3+i*5] - state_next[:, 0]) + torch.square(state_next[:, 3+i*5+1] - state_next[:, 1])))
+        # all obstacles are stepped as one batch of batch_size * n_obstacle robots driven by their own velocities,
+        # unless their next states are given by obstacle_trajectory
+        if obs_next is None:
+            obs_state = state[:, 8:].reshape(-1, 5)
+            obs_state = self.robot.f_xu(obs_state, obs_state[:, 3:5], self.dt, 'obs').reshape(state.shape[0], self.n_obstacle, 5)
+        else:
+            obs_state = obs_next
+        state_next = torch.cat((robot_state, tracking_error, obs_state.flatten(1)), 1)
 
+        veh2vehdist = self.safe_dis - torch.sqrt(torch.square(obs_state[:, :, :2] - robot_state[:, None, :2]).sum(2))
 
         ############################################################################################
         # define the reward function here the format is just like: reward = l(state,state_next,reward)
@@ -85,17 +146,55 @@ class PythMobilerobot2Model:
 
         return state_next, reward, isdone, info
 
-    # def forward_n_step(self, func, n, state: torch.Tensor):
-    #     reward = torch.zeros(size=[state.size()[0], n])
-    #     isdone = state.numpy() <= self.hb_state | state.numpy() >= self.lb_state
-    #     if np.sum(isdone) > 0:
-    #         warning_msg = "state out of state space!"
-    #         warnings.warn(warning_msg)
-    #     isdone = torch.from_numpy(isdone)
-    #     for step in range(n):
-    #         action = func(state)
-    #         state_next, reward[:, step], isdone = self.forward(state, action, isdone)
-    #         state = state_next
+    def forward_n_step(self, func, n, state: torch.Tensor, beyond_done=None, gamma=1., phi=None, noise=None,
+                       start_step=0, return_states=False, obs_traj=None):
+        """
+        Roll the policy func (state -> action) through the model for n steps, one forward call per step.
+        :param gamma: discount factor, step i of the horizon is weighted by gamma ** (start_step + i)
+        :param phi: map of the constraint accumulated by product, the 0/1 safety indicator by default
+        :param noise: [n, batch, 2] ego noise of every step, drawn in one call if not given
+        :param start_step: index of the first step in a longer horizon, for the discount
+        :param return_states: also return the visited states
+        :param obs_traj: [batch, n, n_obstacle, 5] obstacle states from obstacle_trajectory, computed here if not
+            given, so that the steps only simulate the ego robot
+        :return: dict of
+            reward [n, batch], constraint and done [n, batch, n_obstacle]: values of every step
+            reward_sum [batch]: discounted reward sum
+            constraint_mul [batch, n_obstacle]: product of phi(constraint) over the steps
+            is_safe [batch, n_obstacle]: 1 if no constraint was violated, without gradient
+            state, last_state: final state and input state of the last step
+            states [n + 1, batch, state_dim]: initial and visited states, only with return_states
+        """
+        if noise is None:
+            noise = self.sample_noise(n, state.shape[0])
+        if obs_traj is None:
+            obs_traj = self.obstacle_trajectory(state, n)
+        rewards, constraints, dones = [], [], []
+        states = [state]
+        reward_sum = torch.zeros(state.shape[0])
+        constraint_mul = torch.ones(state.shape[0], self.n_obstacle)
+        is_safe = torch.ones(state.shape[0], self.n_obstacle)
+        for step in range(n):
+            last_state = state
+            action = func(state)
+            state, reward, beyond_done, info = self.forward(state, action, beyond_done, noise[step], obs_traj[:, step])
+            constraint = info['constraint']
+            reward_sum = reward_sum + gamma ** (start_step + step) * reward
+            is_safe = is_safe * (constraint.detach() <= 0)
+            constraint_mul = constraint_mul * (phi(constraint) if phi is not None else (constraint <= 0))
+            rewards.append(reward)
+            constraints.append(constraint)
+            dones.append(beyond_done)
+            if return_states:
+                states.append(state)
+
+        # one allocation per output, writes into a preallocated tensor would make autograd copy it every step
+        out = dict(reward=torch.stack(rewards), constraint=torch.stack(constraints), done=torch.stack(dones),
+                   reward_sum=reward_sum, constraint_mul=constraint_mul, is_safe=is_safe,
+                   state=state, last_state=last_state)
+        if return_states:
+            out['states'] = torch.stack(states)
+        return out
 
 
 class Robot():
@@ -109,30 +208,27 @@ class Robot():
                                  )
         self.path = path
 
-    def f_xu(self, states, actions, T, type):
+    std_type = {'ego': [0.08, 0.05], 'obs': [0.0, 0.0], 'none': [0, 0], 'explore': [0.3, 0.3]}
+
+    def sample_noise(self, shape, type, generator=None):
+        """
+        Noise on the (v, w) commands, shape [*shape, 2].
+        """
+        stds = self.std_type[type]
+        if not any(stds):
+            return torch.zeros(*shape, 2)
+        return torch.randn(*shape, 2, generator=generator) * torch.tensor(stds) * 0.5
+
+    def f_xu(self, states, actions, T, type, noise=None):
         v_delta_max = self.robot_params['v_delta_max']
         v_max = self.robot_params['v_max']
         w_max = self.robot_params['w_max']
         w_delta_max = self.robot_params['w_delta_max']
-        std_type = {'ego': [0.08, 0.05], 'obs': [0.0, 0.0], 'none': [0, 0], 'explore': [0.3, 0.3]}
-        stds = std_type[type]
-
-        x, y, theta, v, w = states[:, 0], states[:, 1], states[:, 2], states[:, 3], states[:, 4]
-        v_cmd, w_cmd = actions[:, 0], actions[:, 1]
-
-        delta_v = torch.clamp(v_cmd - v, -v_delta_max * T, v_delta_max * T)
-        delta_w = torch.clamp(w_cmd - w, -w_delta_max * T, w_delta_max * T)
-        v_cmd = torch.clamp(v + delta_v, -v_max, v_max) + torch.Tensor(
-            np.random.normal(0, stds[0], [states.shape[0]])) * 0.5
-        w_cmd = torch.clamp(w + delta_w, -w_max, w_max) + torch.Tensor(
-            np.random.normal(0, stds[1], [states.shape[0]])) * 0.5
-        next_state = [x + T * torch.cos(theta) * v_cmd,
-                      y + T * torch.sin(theta) * v_cmd,
-                      theta + T * w_cmd,
-                      v_cmd,
-                      w_cmd]
-
-        return torch.stack(next_state, 1)
+
+        if noise is None:
+            noise = self.sample_noise((states.shape[0],), type)
+        limits = (v_delta_max * T, v_max, w_delta_max * T, w_max)
+        return UnicycleStep.apply(states, actions, noise[:, 0], noise[:, 1], T, limits)
 
     def tracking_error(self, x):
         error_position = x[:, 1]
@@ -144,6 +240,63 @@ class Robot():
         tracking = torch.cat((error_position.reshape(-1, 1), error_head.reshape(-1, 1), error_v.reshape(-1, 1)), 1)
         return tracking
 
+class UnicycleStep(torch.autograd.Function):
+    """
+    One step of the unicycle dynamics with rate and magnitude limited commands, fused into a single
+    autograd node with an analytic backward instead of the ~15 elementwise nodes of the plain expression.
+    """
+
+    @staticmethod
+    def forward(ctx, states, actions, v_noise, w_noise, T, limits):
+        v_delta_lim, v_max, w_delta_lim, w_max = limits
+        theta, v, w = states[:, 2], states[:, 3], states[:, 4]
+
+        # the masks reproduce the gradient of torch.clamp, which passes where min <= input <= max
+        delta_v = actions[:, 0] - v
+        v_rate_ok = (delta_v >= -v_delta_lim) & (delta_v <= v_delta_lim)
+        v_next = v + delta_v.clamp(-v_delta_lim, v_delta_lim)
+        v_mag_ok = (v_next >= -v_max) & (v_next <= v_max)
+        v_next = v_next.clamp(-v_max, v_max) + v_noise
+
+        delta_w = actions[:, 1] - w
+        w_rate_ok = (delta_w >= -w_delta_lim) & (delta_w <= w_delta_lim)
+        w_next = w + delta_w.clamp(-w_delta_lim, w_delta_lim)
+        w_mag_ok = (w_next >= -w_max) & (w_next <= w_max)
+        w_next = w_next.clamp(-w_max, w_max) + w_noise
+
+        cos_theta, sin_theta = torch.cos(theta), torch.sin(theta)
+        next_state = torch.stack([states[:, 0] + T * cos_theta * v_next,
+                                  states[:, 1] + T * sin_theta * v_next,
+                                  theta + T * w_next,
+                                  v_next,
+                                  w_next], 1)
+
+        ctx.T = T
+        ctx.save_for_backward(cos_theta, sin_theta, v_next, v_rate_ok, v_mag_ok, w_rate_ok, w_mag_ok)
+        return next_state
+
+    @staticmethod
+    def backward(ctx, grad):
+        cos_theta, sin_theta, v_next, v_rate_ok, v_mag_ok, w_rate_ok, w_mag_ok = ctx.saved_tensors
+        T = ctx.T
+        g_x, g_y, g_theta, g_v, g_w = grad.unbind(1)
+
+        g_v_next = T * (g_x * cos_theta + g_y * sin_theta) + g_v
+        g_w_next = T * g_theta + g_w
+        g_v_pre = g_v_next * v_mag_ok
+        g_w_pre = g_w_next * w_mag_ok
+        g_v_cmd = g_v_pre * v_rate_ok
+        g_w_cmd = g_w_pre * w_rate_ok
+
+        grad_states = torch.stack([g_x,
+                                   g_y,
+                                   g_theta + T * v_next * (g_y * cos_theta - g_x * sin_theta),
+                                   g_v_pre - g_v_cmd,
+                                   g_w_pre - g_w_cmd], 1)
+        grad_actions = torch.stack([g_v_cmd, g_w_cmd], 1)
+        return grad_states, grad_actions, g_v_next, g_w_next, None, None
+
+
 def clip_by_tensor(t, t_min, t_max):
     """
     clip_by_tensor
@@ -0,0 +1,63 @@
+#  Copyright (c). All Rights Reserved.
+#  General Optimal control Problem Solver (GOPS)
+#  Intelligent Driving Lab(iDLab), Tsinghua University
+#
+#  Creator: Yang GUAN
+#  Description: Disk-backed reply buffer
+
+
+import json
+import os
+
+import numpy as np
+
+from modules.trainer.buffer.replay_buffer import ReplayBuffer
+
+__all__ = ['MemmapReplayBuffer']
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer whose fields are np.memmap files in buffer_dir, save_folder/buffer by default, so that
+    its capacity is bounded by the disk instead of the RAM. A directory holding a buffer of the same layout
+    is reopened together with its fill state, the trainers then skip the warm-up.
+    """
+
+    def __init__(self, **kwargs):
+        self.buffer_dir = kwargs.get('buffer_dir') or os.path.join(kwargs['save_folder'], 'buffer')
+        if 'buffer_index' in kwargs.keys():  # one directory per buffer actor
+            self.buffer_dir = os.path.join(self.buffer_dir, str(kwargs['buffer_index']))
+        super().__init__(**kwargs)
+        self.ptr, self.size = int(self.fill_state[0]), int(self.fill_state[1])
+
+    def allocate(self):
+        os.makedirs(self.buffer_dir, exist_ok=True)
+        layout = {k: [list(shape), np.dtype(dtype).str] for k, (shape, dtype) in self.storage_layout().items()}
+        layout_file = os.path.join(self.buffer_dir, 'layout.json')
+        reopen = os.path.exists(layout_file)
+        if reopen:
+            with open(layout_file, 'r', encoding='utf-8') as f:
+                if json.load(f) != layout:
+                    raise ValueError('the buffer in {} has a different layout'.format(self.buffer_dir))
+        mode = 'r+' if reopen else 'w+'
+        # ptr and size, updated after every insertion
+        self.fill_state = np.memmap(os.path.join(self.buffer_dir, 'fill_state.bin'), dtype=np.int64, mode=mode,
+                                    shape=(2,))
+        buf = {k: np.memmap(os.path.join(self.buffer_dir, k + '.bin'), dtype=dtype, mode=mode, shape=tuple(shape))
+               for k, (shape, dtype) in layout.items()}
+        if not reopen:
+            with open(layout_file, 'w', encoding='utf-8') as f:
+                json.dump(layout, f)
+        return buf
+
+    def store(self, *args, **kwargs):
+        super().store(*args, **kwargs)
+        self.fill_state[:] = self.ptr, self.size
+
+    def add_columns(self, samples):
+        super().add_columns(samples)
+        self.fill_state[:] = self.ptr, self.size
+
+    def sample_idxs(self, batch_size):
+        # gathering in file order touches every page at most once and lets the OS read ahead
+        return np.sort(super().sample_idxs(batch_size))
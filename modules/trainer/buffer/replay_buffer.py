@@ -7,10 +7,9 @@
 
 
 import numpy as np
-import sys
 import torch
 
-__all__ = ['ReplayBuffer']
+__all__ = ['ReplayBuffer', 'buffer_fields', 'unpack_batch']
 
 
 def combined_shape(length, shape=None):
@@ -19,6 +18,58 @@ def combined_shape(length, shape=None):
     return (length, shape) if np.isscalar(shape) else (length, *shape)
 
 
+def buffer_fields(**kwargs):
+    """
+    Stored fields and the dimension of one transition of each (None for scalars), in storage order.
+    With buffer_keys only the listed fields are stored, the ones the algorithm reads.
+    """
+    fields = {'obs': kwargs['obsv_dim'],
+              'obs2': kwargs['obsv_dim'],
+              'act': kwargs['action_dim'],
+              'rew': None,
+              'done': None,
+              'logp': None}
+    if 'constraint_dim' in kwargs.keys():
+        fields['con'] = kwargs['constraint_dim']
+    if 'adversary_dim' in kwargs.keys():
+        fields['advers'] = kwargs['adversary_dim']
+    if kwargs.get('buffer_keys'):
+        fields = {k: dim for k, dim in fields.items() if k in kwargs['buffer_keys']}
+    return fields
+
+
+# storage dtypes selectable per field, bfloat16 is kept as the upper half of the float32 bits
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16}
+
+
+def to_bfloat16(x):
+    # round to nearest even on the dropped lower 16 bits
+    bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+    return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+
+
+def from_bfloat16(x, out=None):
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+    np.left_shift(x, 16, out=out.view(np.uint32), dtype=np.uint32)
+    return out
+
+
+def unpack_batch(packed, fields):
+    """
+    Dict of tensors viewing the packed array of ReplayBuffer.sample_batch_packed, without copying.
+    """
+    row_width = sum(int(np.prod(combined_shape(1, dim))) for dim in fields.values())
+    batch_size = packed.size // row_width
+    batch, offset = {}, 0
+    for k, dim in fields.items():
+        shape = combined_shape(batch_size, dim)
+        n = int(np.prod(shape))
+        batch[k] = torch.from_numpy(packed[offset:offset + n].reshape(shape))
+        offset += n
+    return batch
+
+
 class ReplayBuffer():
     """
     return torch.tensors
@@ -28,47 +79,219 @@ class ReplayBuffer():
         self.obsv_dim = kwargs['obsv_dim']
         self.act_dim = kwargs['action_dim']
         self.max_size = kwargs['buffer_max_size']
-        self.buf = {'obs': np.zeros(combined_shape(self.max_size, self.obsv_dim), dtype=np.float32),
-                    'obs2': np.zeros(combined_shape(self.max_size, self.obsv_dim), dtype=np.float32),
-                    'act': np.zeros(combined_shape(self.max_size, self.act_dim), dtype=np.float32),
-                    'rew': np.zeros(self.max_size, dtype=np.float32),
-                    'done': np.zeros(self.max_size, dtype=np.float32),
-                    'logp': np.zeros(self.max_size, dtype=np.float32)}
+        self.fields = buffer_fields(**kwargs)
+        # store every observation once, obs2 is gathered from the slot holding the next observation
+        self.dedup_obs2 = kwargs.get('dedup_obs2', False) and 'obs' in self.fields and 'obs2' in self.fields
+        # rows of a sampler batch that follow each other in time, one per robot stepped together
+        self.link_stride = kwargs.get('sample_agents', 1)
+        # storage dtype of each field, e.g. {'obs': 'float16', 'obs2': 'float16'}, sampled batches stay float32
+        self.dtypes = {k: 'float32' for k in self.fields.keys()}
+        for k, dtype in (kwargs.get('buffer_dtypes') or {}).items():
+            if dtype not in STORAGE_DTYPES.keys():
+                raise ValueError('unsupported buffer dtype {} of {}'.format(dtype, k))
+            if k in self.dtypes.keys():
+                self.dtypes[k] = dtype
+        self.buf = self.allocate()
         if 'constraint_dim' in kwargs.keys():
             self.con_dim = kwargs['constraint_dim']
-            self.buf['con'] = np.zeros(combined_shape(self.max_size, self.con_dim), dtype=np.float32)
         if 'adversary_dim' in kwargs.keys():
             self.advers_dim = kwargs['adversary_dim']
-            self.buf['advers'] = np.zeros(combined_shape(self.max_size, self.advers_dim), dtype=np.float32)
         self.ptr, self.size, = 0, 0
+        # transitions inserted and sampled so far, the trainers turn them into rates
+        self.n_inserted, self.n_sampled = 0, 0
+        # sample_batch gathers into a ring of this many reusable output batches, 0 allocates fresh tensors.
+        # A returned batch is overwritten sample_out_ring calls later.
+        self.sample_out_ring = kwargs.get('sample_out_ring', 0)
+        self.pin_memory = kwargs.get('use_gpu', False) and torch.cuda.is_available()
+        self.sample_outs = {}
+
+    def storage_layout(self):
+        """
+        Shape and dtype of every stored array. With dedup_obs2 the slots hold either a transition or, at an
+        episode boundary, only the next observation of the transition before. next_slot is the slot of the
+        next observation of each transition, is_transition marks the slots that can be sampled.
+        """
+        layout = {k: (combined_shape(self.max_size, dim), STORAGE_DTYPES[self.dtypes[k]])
+                  for k, dim in self.fields.items()}
+        if self.dedup_obs2:
+            del layout['obs2']
+            layout['next_slot'] = ((self.max_size,), np.int32 if self.max_size < 2 ** 31 else np.int64)
+            layout['is_transition'] = ((self.max_size,), np.bool_)
+        return layout
+
+    def allocate(self):
+        return {k: np.zeros(shape, dtype=dtype) for k, (shape, dtype) in self.storage_layout().items()}
 
     def __len__(self):
         return self.size
 
     def __get_RAM__(self):
-        return int(sys.getsizeof(self.buf)) * self.size / (self.max_size * 1000000)
+        # MB held by the stored transitions
+        return self.memory_info()['used'] / 1e6
+
+    def memory_info(self):
+        """
+        Bytes allocated for the stored arrays and the reusable sample outputs, bytes used by the stored
+        transitions, and the transitions inserted and sampled so far.
+        """
+        stored = sum(v.nbytes for v in self.buf.values())
+        sample_outs = sum(t.nbytes for ring, _ in self.sample_outs.values() for batch in ring for t in batch.values())
+        return {'allocated': stored + sample_outs,
+                'used': stored * self.size // self.max_size,
+                'inserted': self.n_inserted,
+                'sampled': self.n_sampled}
 
     def store(self, obs, act, rew, next_obs, done, logp, time_limited, con=None, advers=None):
-        self.buf['obs'][self.ptr] = obs
-        self.buf['obs2'][self.ptr] = next_obs
-        self.buf['act'][self.ptr] = act
-        self.buf['rew'][self.ptr] = rew
-        self.buf['done'][self.ptr] = done
-        self.buf['logp'][self.ptr] = logp
-        if con is not None and 'con' in self.buf.keys():
-            self.buf['con'][self.ptr] = con
-        if advers is not None and 'advers' in self.buf.keys():
-            self.buf['advers'][self.ptr] = advers
+        if self.dedup_obs2:
+            self.add_columns(self.rows_to_columns([(obs, act, rew, next_obs, done, logp, time_limited, con, advers)]))
+            return
+        for k, v in (('obs', obs), ('obs2', next_obs), ('act', act), ('rew', rew), ('done', done), ('logp', logp),
+                     ('con', con), ('advers', advers)):
+            if v is not None and k in self.buf.keys():
+                self.buf[k][self.ptr] = self.encode(k, v)
         self.ptr = (self.ptr + 1) % self.max_size  # 控制buffer的内存
         self.size = min(self.size + 1, self.max_size)
+        self.n_inserted += 1
 
     def add_batch(self, samples):
-        for sample in samples:
-            self.store(*sample)
+        if not isinstance(samples, dict):
+            samples = self.rows_to_columns(samples)
+        self.add_columns(samples)
 
-    def sample_batch(self, batch_size):
+    def rows_to_columns(self, samples):
+        """
+        Columnar form of a list of transition tuples in the argument order of store.
+        """
+        n = len(samples)
+        columns = {}
+        for k, i in (('obs', 0), ('act', 1), ('rew', 2), ('obs2', 3), ('done', 4), ('logp', 5), ('con', 7), ('advers', 8)):
+            if k in self.fields and n > 0 and len(samples[0]) > i and samples[0][i] is not None:
+                columns[k] = np.asarray([sample[i] for sample in samples], dtype=np.float32).reshape(
+                    combined_shape(n, self.fields[k]))
+        return columns
+
+    def add_columns(self, samples):
+        """
+        Insert a columnar sample batch, a dict of arrays with one row per transition.
+        """
+        self.n_inserted += len(samples['obs'])
+        if self.dedup_obs2:
+            samples = self.link_transitions(samples)
+        self.write_slots(samples)
+
+    def link_transitions(self, samples):
+        """
+        Slot columns of a sample batch without obs2. Row i is linked to row i + link_stride when that row
+        starts from obs2[i], the others are episode boundaries (or the last step of the batch) and their obs2
+        go to extra slots after the transitions.
+        """
+        obs, obs2 = samples['obs'], samples['obs2']
+        n, s = len(obs), self.link_stride
+        linked = np.zeros(n, dtype=np.bool_)
+        if n > s:
+            linked[:-s] = np.all(obs[s:] == obs2[:-s], axis=tuple(range(1, obs.ndim)))
+        boundary = np.flatnonzero(~linked)
+        extra_rows = n + np.arange(len(boundary))
+        next_row = np.arange(n) + s
+        next_row[boundary] = extra_rows
+        next_row = np.concatenate((next_row, extra_rows))  # the extra slots point to themselves
+        slots = {'obs': np.concatenate((obs, obs2[boundary])),
+                 'next_slot': (self.ptr + next_row) % self.max_size,
+                 'is_transition': np.arange(n + len(boundary)) < n}
+        for k, v in samples.items():
+            if v is not None and k not in slots and k != 'obs2':
+                slots[k] = np.concatenate((v, np.zeros((len(boundary),) + v.shape[1:], dtype=v.dtype)))
+        return slots
+
+    def write_slots(self, samples):
+        """
+        Every stored array is written with at most two slice assignments, the second one for the part that
+        wraps around max_size.
+        """
+        n = len(samples['obs'])
+        if n > self.max_size:  # only the newest max_size transitions survive, at the slots they would overwrite
+            self.ptr = (self.ptr + n - self.max_size) % self.max_size
+            samples = {k: v[n - self.max_size:] for k, v in samples.items() if v is not None}
+            n = self.max_size
+        first = min(n, self.max_size - self.ptr)
+        for k, v in self.buf.items():
+            column = samples.get(k)
+            if column is None:
+                continue
+            if k in self.dtypes.keys():
+                column = self.encode(k, column)
+            v[self.ptr:self.ptr + first] = column[:first]
+            if first < n:
+                v[:n - first] = column[first:]
+        self.ptr = (self.ptr + n) % self.max_size
+        self.size = min(self.size + n, self.max_size)
+
+    def sample_idxs(self, batch_size):
+        self.n_sampled += batch_size
         idxs = np.random.randint(0, self.size, size=batch_size)
+        if self.dedup_obs2:  # redraw the slots holding only a next observation
+            miss = ~self.buf['is_transition'][idxs]
+            while miss.any():
+                idxs[miss] = np.random.randint(0, self.size, size=int(miss.sum()))
+                miss[miss] = ~self.buf['is_transition'][idxs[miss]]
+        return idxs
+
+    def encode(self, k, v):
+        # the float16 casts go through torch, several times faster than numpy's
+        if self.dtypes[k] == 'float16':
+            return torch.as_tensor(np.asarray(v), dtype=torch.float16).numpy()
+        if self.dtypes[k] == 'bfloat16':
+            return to_bfloat16(v)
+        return v
+
+    def gather(self, k, idxs, out=None):
+        """
+        Rows idxs of field k as float32, reduced precision fields are upcast in bulk after the gather.
+        """
+        if k == 'obs2' and self.dedup_obs2:
+            k, idxs = 'obs', self.buf['next_slot'][idxs]
+        if self.dtypes[k] == 'float32':
+            return np.take(self.buf[k], idxs, axis=0, out=out)
+        rows = np.take(self.buf[k], idxs, axis=0)
+        if self.dtypes[k] == 'bfloat16':
+            return from_bfloat16(rows, out=out)
+        if out is None:
+            return torch.from_numpy(rows).float().numpy()
+        torch.from_numpy(out).copy_(torch.from_numpy(rows))
+        return out
+
+    def sample_batch(self, batch_size):
+        idxs = self.sample_idxs(batch_size)
+        if self.sample_out_ring:
+            batch = self.next_sample_out(batch_size)
+            for k in self.fields.keys():
+                self.gather(k, idxs, out=batch[k].numpy())
+            return batch
         batch = {}
-        for k, v in self.buf.items():
-            batch[k] = v[idxs]
+        for k in self.fields.keys():
+            batch[k] = self.gather(k, idxs)
         return {k: torch.as_tensor(v, dtype=torch.float32) for k, v in batch.items()}
+
+    def next_sample_out(self, batch_size):
+        # the ring is filled lazily, one per batch size, in pinned memory when the learners use the GPU
+        ring, count = self.sample_outs.get(batch_size, ([], 0))
+        if len(ring) < self.sample_out_ring:
+            ring.append({k: torch.empty(combined_shape(batch_size, dim), pin_memory=self.pin_memory)
+                         for k, dim in self.fields.items()})
+        self.sample_outs[batch_size] = (ring, count + 1)
+        return ring[count % self.sample_out_ring]
+
+    def sample_batch_packed(self, batch_size):
+        """
+        Sampled batch as one contiguous float32 array, the fields one after another in storage order, each
+        laid out as [batch_size, *dim]. Ray ships it without pickling, unpack_batch views it as a dict.
+        """
+        idxs = self.sample_idxs(batch_size)
+        shapes = [combined_shape(batch_size, dim) for dim in self.fields.values()]
+        packed = np.empty(sum(int(np.prod(shape)) for shape in shapes), dtype=np.float32)
+        offset = 0
+        for k, shape in zip(self.fields.keys(), shapes):
+            n = int(np.prod(shape))
+            self.gather(k, idxs, out=packed[offset:offset + n].reshape(shape))
+            offset += n
+        return packed
@@ -41,6 +41,8 @@ class OffAsyncTrainer():
         self.evaluator = evaluator
         self.iteration = 0
         self.replay_batch_size = kwargs['replay_batch_size']
+        # learners receive one packed array per batch instead of a dict of tensors
+        self.packed_replay = kwargs.get('packed_replay', False)
         self.max_iteration = kwargs['max_iteration']
         self.ini_network_dir = kwargs['ini_network_dir']
         self.save_folder = kwargs['save_folder']
@@ -89,6 +91,7 @@ class OffAsyncTrainer():
         self._set_algs()
 
         self.start_time = time.time()
+        self.buffer_log_time, self.buffer_log_info = self.start_time, self.buffer_memory_info()
 
     def _set_samplers(self):
         weights = self.networks.state_dict()  # 得到中心网络参数
@@ -101,9 +104,31 @@ class OffAsyncTrainer():
         for alg in self.algs:
             alg.load_state_dict.remote(weights)  # 每个learner同步参数
             buffer, _ = random_choice_with_index(self.buffers)  # 随机选择一个buffer从中采样
-            data = ray.get(buffer.sample_batch.remote(self.replay_batch_size))  # 得到buffer的采样结果
+            data = ray.get(self.sample_replay(buffer))  # 得到buffer的采样结果
             self.learn_tasks.add(alg, alg.compute_gradient.remote(data, self.iteration))  # 用采样结果给learner添加计算梯度的任务
 
+    def sample_replay(self, buffer):
+        if self.packed_replay:
+            return buffer.sample_batch_packed.remote(self.replay_batch_size)
+        return buffer.sample_batch.remote(self.replay_batch_size)
+
+    def buffer_memory_info(self):
+        # summed over the buffer shards
+        infos = ray.get([buffer.memory_info.remote() for buffer in self.buffers])
+        return {k: sum(info[k] for info in infos) for k in infos[0].keys()}
+
+    def log_buffer_info(self, info):
+        # used and allocated MB, transitions inserted and sampled per second since the last call
+        now = time.time()
+        elapsed = max(now - self.buffer_log_time, 1e-6)
+        self.writer.add_scalar(tb_tags['Buffer RAM of RL iteration'], info['used'] / 1e6, self.iteration)
+        self.writer.add_scalar(tb_tags['buffer_allocated'], info['allocated'] / 1e6, self.iteration)
+        self.writer.add_scalar(tb_tags['buffer_insert_rate'],
+                               (info['inserted'] - self.buffer_log_info['inserted']) / elapsed, self.iteration)
+        self.writer.add_scalar(tb_tags['buffer_sample_rate'],
+                               (info['sampled'] - self.buffer_log_info['sampled']) / elapsed, self.iteration)
+        self.buffer_log_time, self.buffer_log_info = now, info
+
     def step(self):
         # sampling
         sampler_tb_dict = {}
@@ -117,7 +142,7 @@ class OffAsyncTrainer():
         # learning
         for alg, objID in self.learn_tasks.completed():
             grads, alg_tb_dict = ray.get(objID)
-            data = random.choice(self.buffers).sample_batch.remote(self.replay_batch_size)
+            data = self.sample_replay(random.choice(self.buffers))
             weights = ray.put(self.networks.state_dict())  # 把中心网络的参数放在底层内存里面
             alg.load_state_dict.remote(weights)  # 更新learner参数
             self.learn_tasks.add(alg, alg.compute_gradient.remote(data, self.iteration))  # 将完成了的learner重新算梯度
@@ -136,9 +161,7 @@ class OffAsyncTrainer():
                 #self.evaluator.render_batch()
                 total_avg_return = ray.get(self.evaluator.run_evaluation.remote(self.iteration))
                 # get ram for buffer
-                self.writer.add_scalar(tb_tags['Buffer RAM of RL iteration'],
-                                       sum(ray.get([buffer.__get_RAM__.remote() for buffer in self.buffers])),
-                                       self.iteration)
+                self.log_buffer_info(self.buffer_memory_info())
                 self.writer.add_scalar(tb_tags['TAR of RL iteration'],
                                        total_avg_return,
                                        self.iteration)
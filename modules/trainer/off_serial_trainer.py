@@ -62,6 +62,7 @@ class OffSerialTrainer():
         self.writer.add_scalar(tb_tags['alg_time'], 0, 0)
         self.writer.add_scalar(tb_tags['sampler_time'], 0, 0)
         self.start_time = time.time()
+        self.buffer_log_time, self.buffer_log_info = self.start_time, self.buffer.memory_info()
         self.writer.flush()
         # setattr(self.alg, "writer", self.evaluator.writer)
 
@@ -93,9 +94,7 @@ class OffSerialTrainer():
             self.evaluator.networks.load_state_dict(self.networks.state_dict())
             #self.evaluator.render_batch()
             total_avg_return = self.evaluator.run_evaluation(self.iteration)
-            self.writer.add_scalar(tb_tags['Buffer RAM of RL iteration'],
-                                   self.buffer.__get_RAM__(),
-                                   self.iteration)
+            self.log_buffer_info(self.buffer.memory_info())
             self.writer.add_scalar(tb_tags['TAR of RL iteration'],
                                    total_avg_return,
                                    self.iteration)
@@ -114,6 +113,18 @@ class OffSerialTrainer():
             torch.save(self.networks.state_dict(),
                        self.save_folder + '/apprfunc/apprfunc_{}.pkl'.format(self.iteration))
 
+    def log_buffer_info(self, info):
+        # used and allocated MB, transitions inserted and sampled per second since the last call
+        now = time.time()
+        elapsed = max(now - self.buffer_log_time, 1e-6)
+        self.writer.add_scalar(tb_tags['Buffer RAM of RL iteration'], info['used'] / 1e6, self.iteration)
+        self.writer.add_scalar(tb_tags['buffer_allocated'], info['allocated'] / 1e6, self.iteration)
+        self.writer.add_scalar(tb_tags['buffer_insert_rate'],
+                               (info['inserted'] - self.buffer_log_info['inserted']) / elapsed, self.iteration)
+        self.writer.add_scalar(tb_tags['buffer_sample_rate'],
+                               (info['sampled'] - self.buffer_log_info['sampled']) / elapsed, self.iteration)
+        self.buffer_log_time, self.buffer_log_info = now, info
+
     def train(self):
         while self.iteration < self.max_iteration:
             self.step()
@@ -16,13 +16,18 @@ from modules.utils.action_distributions import GaussDistribution, DiracDistribut
 from modules.utils.noise import GaussNoise, EpsilonGreedy
 import time
 from modules.utils.tensorboard_tools import tb_tags
-from modules.utils.utils import array_to_scalar
+from modules.utils.utils import array_to_scalar, sample_columns
 
 
 
 class OffSampler():
     def __init__(self, **kwargs):
-        self.env = create_env(**kwargs)
+        # number of robots stepped together by one batched policy call, the env resets the finished ones itself
+        self.sample_agents = kwargs.get('sample_agents', 1)
+        if self.sample_agents > 1:
+            self.env = create_env(**dict(kwargs, auto_reset=True))
+        else:
+            self.env = create_env(**kwargs)
         alg_name = kwargs['algorithm']
         alg_file_name = alg_name.lower()
         file = __import__(alg_file_name)
@@ -30,7 +35,9 @@ class OffSampler():
         self.networks = ApproxContainer(**kwargs)
         self.noise_params = kwargs['noise_params']
         self.sample_batch_size = kwargs['sample_batch_size']
-        self.obs = self.env.reset()
+        # fields kept by the buffers, the others are not shipped
+        self.buffer_keys = kwargs.get('buffer_keys', None)
+        self.obs = self.env.reset() if self.sample_agents == 1 else self.env.reset(self.sample_agents)
         self.has_render = hasattr(self.env, 'render')
         self.policy_func_name = kwargs['policy_func_name']
         self.action_type = kwargs['action_type']
@@ -59,16 +66,77 @@ class OffSampler():
                 self.action_distirbution_cls = CategoricalDistribution
             elif self.policy_func_name == 'DetermPolicyDis':
                 self.action_distirbution_cls = ValueDiracDistribution
+        if self.sample_agents > 1:
+            # sample_batch_size rounded up to whole steps of all agents
+            self.vector_steps = -(-self.sample_batch_size // self.sample_agents)
 
     def load_state_dict(self, state_dict):
         self.networks.load_state_dict(state_dict)
 
+    def new_columns(self, size):
+        # fresh arrays for every batch, the batch is handed over to the buffers without a copy
+        return sample_columns(size, self.obsv_dim, self.act_dim, self.con_dim if self.is_constrained else None,
+                              self.advers_dim if self.is_adversary else None)
+
+    def buffer_view(self, batch_data):
+        if self.buffer_keys:
+            return {k: v for k, v in batch_data.items() if k in self.buffer_keys}
+        return batch_data
+
+    def sample_vector(self):
+        """
+        Step all sample_agents robots together, one batched policy call per step, the transitions are written
+        straight into the preallocated columns.
+        """
+        tb_info = dict()
+        start_time = time.time()
+        cols = self.new_columns(self.vector_steps * self.sample_agents)
+        with torch.inference_mode():
+            for step in range(self.vector_steps):
+                rows = slice(step * self.sample_agents, (step + 1) * self.sample_agents)
+                cols['obs'][rows] = self.obs
+                batch_obs = torch.from_numpy(cols['obs'][rows])
+                if self.action_type == 'continu':
+                    logits = self.networks.policy(batch_obs)
+                else:
+                    logits = self.networks.policy.q(batch_obs)
+
+                action_distribution = self.action_distirbution_cls(logits)
+                action = action_distribution.sample()
+                if hasattr(action_distribution, 'log_prob'):
+                    cols['logp'][rows] = action_distribution.log_prob(action).numpy()
+                action = action.numpy()
+                if self.noise_params is not None:
+                    action = self.noise_processor.sample(action)
+                cols['act'][rows] = action
+                next_obs, reward, done, info = self.env.step(cols['act'][rows])
+                truncated = info['TimeLimit.truncated']
+                cols['rew'][rows] = reward
+                cols['obs2'][rows] = next_obs
+                if 'terminal_state' in info:
+                    # next_obs of a finished robot is already its reset state
+                    cols['obs2'][rows][info['finished']] = info['terminal_state']
+                cols['done'][rows] = done & ~truncated
+                cols['time_limited'][rows] = truncated
+                if self.is_constrained:
+                    cols['con'][rows] = info['constraint']
+                self.obs = next_obs
+
+        self.total_sample_number += cols['obs'].shape[0]
+
+        end_time = time.time()
+        tb_info[tb_tags["sampler_time"]] = (end_time - start_time) * 1000
+
+        return self.buffer_view(cols), tb_info
+
     def sample(self):
+        if self.sample_agents > 1:
+            return self.sample_vector()
         self.total_sample_number += self.sample_batch_size
         tb_info = dict()
         start_time = time.time()
-        batch_data = []
-        for _ in range(self.sample_batch_size):
+        batch_data = self.new_columns(self.sample_batch_size)
+        for i in range(self.sample_batch_size):
             batch_obs = torch.from_numpy(np.expand_dims(self.obs, axis=0).astype('float32'))
             if self.action_type == 'continu':
                 logits = self.networks.policy(batch_obs)
@@ -90,18 +158,15 @@ class OffSampler():
                 info['TimeLimit.truncated'] = False
             if info['TimeLimit.truncated']:
                 self.done = False
-            data = [self.obs.copy(), action, reward, next_obs.copy(), self.done, logp, info['TimeLimit.truncated']]
+            batch_data['obs'][i] = self.obs
+            batch_data['act'][i] = action
+            batch_data['rew'][i] = array_to_scalar(reward)
+            batch_data['obs2'][i] = next_obs
+            batch_data['done'][i] = array_to_scalar(self.done)
+            batch_data['logp'][i] = logp
+            batch_data['time_limited'][i] = array_to_scalar(info['TimeLimit.truncated'])
             if self.is_constrained:
-                constraint = info['constraint']
-            else:
-                constraint = None
-            if self.is_adversary:
-                sth_about_adversary = np.zeros(self.advers_dim)
-            else:
-                sth_about_adversary = None
-            data.append(constraint)
-            data.append(sth_about_adversary)
-            batch_data.append(tuple(data))
+                batch_data['con'][i] = info['constraint']
             self.obs = next_obs
             if self.done or info['TimeLimit.truncated']:
                 self.obs = self.env.reset()
@@ -109,7 +174,7 @@ class OffSampler():
         end_time = time.time()
         tb_info[tb_tags["sampler_time"]] = (end_time - start_time) * 1000
 
-        return batch_data, tb_info
+        return self.buffer_view(batch_data), tb_info
 
     def get_total_sample_number(self):
         return self.total_sample_number
@@ -16,7 +16,7 @@ from modules.utils.action_distributions import GaussDistribution, DiracDistribut
 from modules.utils.noise import GaussNoise, EpsilonGreedy
 import time
 from modules.utils.tensorboard_tools import tb_tags
-from modules.utils.utils import array_to_scalar
+from modules.utils.utils import array_to_scalar, sample_columns
 
 
 class OnSampler():
@@ -66,8 +66,10 @@ class OnSampler():
         self.total_sample_number += self.sample_batch_size
         tb_info = dict()
         start_time = time.time()
-        batch_data = []
-        for _ in range(self.sample_batch_size):
+        batch_data = sample_columns(self.sample_batch_size, self.obsv_dim, self.act_dim,
+                                    self.con_dim if self.is_constrained else None,
+                                    self.advers_dim if self.is_adversary else None)
+        for i in range(self.sample_batch_size):
             batch_obs = torch.from_numpy(np.expand_dims(self.obs, axis=0).astype('float32'))
             if self.action_type == 'continu':
                 logits = self.networks.policy(batch_obs)
@@ -89,18 +91,15 @@ class OnSampler():
                 info['TimeLimit.truncated'] = False
             if info['TimeLimit.truncated']:
                 self.done = False
-            data = [self.obs.copy(), action, reward, next_obs.copy(), self.done, logp, info['TimeLimit.truncated']]
+            batch_data['obs'][i] = self.obs
+            batch_data['act'][i] = action
+            batch_data['rew'][i] = array_to_scalar(reward)
+            batch_data['obs2'][i] = next_obs
+            batch_data['done'][i] = array_to_scalar(self.done)
+            batch_data['logp'][i] = logp
+            batch_data['time_limited'][i] = array_to_scalar(info['TimeLimit.truncated'])
             if self.is_constrained:
-                constraint = info['constraint']
-            else:
-                constraint = None
-            if self.is_adversary:
-                sth_about_adversary = np.zeros(self.advers_dim)
-            else:
-                sth_about_adversary = None
-            data.append(constraint)
-            data.append(sth_about_adversary)
-            batch_data.append(tuple(data))
+                batch_data['con'][i] = info['constraint']
             self.obs = next_obs
             if self.done or info['TimeLimit.truncated']:
                 self.obs = self.env.reset()
@@ -114,41 +113,11 @@ class OnSampler():
         return self.total_sample_number
 
     def samples_conversion(self, samples):
-        obs_dim = self.obsv_dim
-        if isinstance(obs_dim, int):
-            obs_dim = (obs_dim,)
-        tensor_dict = {'obs': torch.zeros((self.sample_batch_size,) + obs_dim),
-                       'act': torch.zeros(self.sample_batch_size, self.act_dim),
-                       'obs2': torch.zeros((self.sample_batch_size,) + obs_dim),
-                       'rew': torch.zeros(self.sample_batch_size, ),
-                       'done': torch.zeros(self.sample_batch_size, ),
-                       'logp': torch.zeros(self.sample_batch_size, ),
-                       'time_limited': torch.zeros(self.sample_batch_size, )}
-        if self.is_constrained:
-            tensor_dict['con'] = torch.zeros(self.sample_batch_size, self.con_dim)
-        else:
+        tensor_dict = {k: torch.from_numpy(v) for k, v in samples.items()}
+        if not self.is_constrained:
             tensor_dict['con'] = None
-        if self.is_adversary:
-            tensor_dict['advers'] = torch.zeros(self.sample_batch_size, self.advers_dim)
-        else:
+        if not self.is_adversary:
             tensor_dict['advers'] = None
-        idx = 0
-        for sample in samples:
-            obs, act, rew, next_obs, done, logp, time_limited = sample[:7]
-            tensor_dict['obs'][idx] = torch.from_numpy(obs)
-            tensor_dict['act'][idx] = torch.from_numpy(act)
-            tensor_dict['rew'][idx] = torch.tensor(array_to_scalar(rew))
-            tensor_dict['obs2'][idx] = torch.from_numpy(next_obs)
-            tensor_dict['done'][idx] = torch.tensor(array_to_scalar(done))
-            tensor_dict['logp'][idx] = torch.tensor(logp)
-            tensor_dict['time_limited'][idx] = torch.tensor(time_limited)
-            if self.is_constrained:
-                con = sample[7]
-                tensor_dict['con'][idx] = torch.from_numpy(con)
-            if self.is_adversary:
-                advers = sample[-1]
-                tensor_dict['advers'][idx] = torch.from_numpy(advers)
-            idx += 1
         tensor_dict['time_limited'][-1] = True
         return tensor_dict
 
@@ -35,6 +35,12 @@ def init_args(env, **args):
     if hasattr(env, 'constraint_dim'):  # get the dimension of constrain
         args['constraint_dim'] = env.constraint_dim
 
+    # store and ship only the replay fields the algorithm declares it reads
+    if args.get('compact_buffer', False):
+        alg_cls = getattr(__import__(args['algorithm'].lower()), args['algorithm'])
+        if hasattr(alg_cls, 'batch_keys'):
+            args['buffer_keys'] = list(alg_cls.batch_keys)
+
     # Create save arguments
     if args['save_folder'] is None:
         dir_path = os.path.dirname(__file__)
@@ -60,4 +60,5 @@ class GaussNoise():
         self.std = std
 
     def sample(self, action):
-        return action + np.random.normal(self.mean, self.std)
+        # one draw per element, so a batch of actions is perturbed independently
+        return action + np.random.normal(self.mean, self.std, np.shape(action))
@@ -168,11 +168,22 @@ tb_tags = {'TAR of RL iteration': 'Evaluation/1. TAR-RL iteration',
            'TAR of collected samples': 'Evaluation/3. TAR-Collected samples',
            'TAR of replay samples': 'Evaluation/4. TAR-Replay samples',
            'Buffer RAM of RL iteration': 'RAM/RAM-RL iteration',
+           'learner_peak_rss': 'RAM/learner_peak_RSS [MB]',
+           'buffer_allocated': 'RAM/buffer_allocated [MB]',
+           'buffer_insert_rate': 'Time/buffer_insert_rate [1/s]',
+           'buffer_sample_rate': 'Time/buffer_sample_rate [1/s]',
            'loss_actor': 'Loss/loss_actor',
            'loss_critic': 'Loss/loss_critic',
            'alg_time': 'Time/alg_time',
            'sampler_time': 'Time/sampler_time',
+           'rollout_time': 'Time/rollout_time',
+           'v_time': 'Time/v_time',
+           'prob_time': 'Time/prob_time',
+           'lamnet_time': 'Time/lamnet_time',
+           'policy_time': 'Time/policy_time',
            'critic_avg_value': 'Train/critic_average_value',
+           'state_clip_events': 'Train/state_clip_events',
+           'action_clip_events': 'Train/action_clip_events',
            'safe_probability1': 'Train/safe_prob1',
            'lambda1': 'Train/lambda1',
            'safe_probability2': 'Train/safe_prob2',
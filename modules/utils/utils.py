@@ -106,6 +106,23 @@ def array_to_scalar(arrayLike):
     return arrayLike if isinstance(arrayLike, (int, float)) else arrayLike.item()
 
 
+def sample_columns(size, obsv_dim, act_dim, con_dim=None, advers_dim=None):
+    """Columnar sample batch: one contiguous float32 array per field, rows indexed by sample"""
+    obsv_dim = (obsv_dim,) if np.isscalar(obsv_dim) else tuple(obsv_dim)
+    columns = {'obs': np.zeros((size,) + obsv_dim, dtype=np.float32),
+               'act': np.zeros((size, act_dim), dtype=np.float32),
+               'rew': np.zeros(size, dtype=np.float32),
+               'obs2': np.zeros((size,) + obsv_dim, dtype=np.float32),
+               'done': np.zeros(size, dtype=np.float32),
+               'logp': np.zeros(size, dtype=np.float32),
+               'time_limited': np.zeros(size, dtype=np.float32)}
+    if con_dim is not None:
+        columns['con'] = np.zeros((size, con_dim), dtype=np.float32)
+    if advers_dim is not None:
+        columns['advers'] = np.zeros((size, advers_dim), dtype=np.float32)
+    return columns
+
+
 # class Timer(object):
 #     def __init__(self, writer, tag=tb_tags['time'], step=None):
 #         self.writer = writer